@@ -3,12 +3,60 @@ from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain_community.embeddings.huggingface import HuggingFaceEmbeddings
 from langchain_community.vectorstores import FAISS
 from langchain_community.chat_models import ChatOllama
-from langchain.chains import RetrievalQA
+from langchain.chains.question_answering import load_qa_chain
 from langchain.callbacks.streaming_stdout import StreamingStdOutCallbackHandler
 from langchain.prompts import PromptTemplate
+from langchain_core.retrievers import BaseRetriever
+from index_cache import IndexCache
+from llm_guard import LLM_TIMEOUT_S
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, List, Optional
 import os
 import glob
 
+# Shard for PDFs placed directly in the pdfs directory (not in a plant subfolder)
+DEFAULT_SHARD = "general"
+
+# Per-document indexes are persisted here and loaded on first use
+INDEX_DIR = os.environ.get("INDEX_DIR", "./indexes")
+# Memory budget for resident per-document indexes (LRU eviction above it)
+INDEX_MEMORY_BUDGET_MB = float(os.environ.get("INDEX_MEMORY_BUDGET_MB", "256"))
+
+
+def document_key(shard_name, doc_name):
+    """Key of a per-document index: plants may reuse file names, so it includes the shard"""
+    return doc_name if shard_name == DEFAULT_SHARD else f"{shard_name}/{doc_name}"
+
+
+def _filtered_search(store, embedding, k, metadata_filter):
+    """Filtered FAISS search that widens fetch_k until k chunks match.
+
+    FAISS applies the filter to the fetch_k nearest chunks only; doubling it
+    finds matches for selective filters without scanning the whole shard on
+    every query.
+    """
+    fetch_k = max(20, 4 * k)
+    while True:
+        results = store.similarity_search_with_score_by_vector(
+            embedding, k=k, filter=metadata_filter, fetch_k=fetch_k
+        )
+        if len(results) >= k or fetch_k >= store.index.ntotal:
+            return results
+        fetch_k *= 2
+
+
+class ShardedRetriever(BaseRetriever):
+    """Retriever that fans a query out over several shards and merges the top-k"""
+
+    manager: Any
+    shards: Optional[List[str]] = None
+    metadata_filter: Optional[dict] = None
+    k: int = 2
+
+    def _get_relevant_documents(self, query, *, run_manager=None):
+        return self.manager.search(query, k=self.k, shards=self.shards, metadata_filter=self.metadata_filter)
+
+
 class DocumentManager:
     _instance = None
     
@@ -20,8 +68,14 @@ class DocumentManager:
     
     def __init__(self):
         if not self.initialized:
-            self.documents = {}  # Store document name -> vectorstore mapping
-            self.combined_vectorstore = None
+            self.documents = IndexCache(  # Store document name -> vectorstore mapping (lazy, on disk)
+                INDEX_DIR,
+                int(INDEX_MEMORY_BUDGET_MB * 1024 * 1024),
+                loader=self._load_index,
+            )
+            self.shards = {}  # Store shard (plant/collection) name -> vectorstore mapping
+            self.shard_documents = {}  # Store shard name -> list of document names
+            self.search_pool = ThreadPoolExecutor(max_workers=os.cpu_count() or 4)
             self.llm = None
             self.embeddings = None
             self.initialized = True
@@ -35,68 +89,201 @@ class DocumentManager:
             callbacks=callbacks,
             base_url="http://host.docker.internal:11434",  # Connect to host machine Ollama
             temperature=temperature,  # Lower = more deterministic/cold
+            timeout=int(LLM_TIMEOUT_S),  # A hung Ollama call must not hold its worker forever
             system="Eres un asistente que SIEMPRE responde en español. Sin importar el idioma de entrada, tu respuesta debe estar completamente en español. Eres un ingeniero químico de COMPANY_NAME especializado en seguridad industrial y alertas de incidentes."
         )
         print(f"LLM initialized - Model: {model_name}, Temperature: {temperature}, Language: Español")
         return self.llm
     
+    def find_shard_pdfs(self, pdf_dir="./pdfs"):
+        """Group PDFs by shard: one subfolder per plant/collection, loose PDFs go to DEFAULT_SHARD"""
+        shard_pdfs = {}
+        loose = sorted(glob.glob(os.path.join(pdf_dir, "*.pdf")))
+        if loose:
+            shard_pdfs[DEFAULT_SHARD] = loose
+        for shard_dir in sorted(glob.glob(os.path.join(pdf_dir, "*", ""))):
+            pdfs = sorted(glob.glob(os.path.join(shard_dir, "*.pdf")))
+            if pdfs:
+                shard_name = os.path.basename(os.path.normpath(shard_dir))
+                if shard_name == DEFAULT_SHARD:
+                    # Would share index keys with the loose PDFs and overwrite them
+                    print(f"Warning: skipping subfolder '{shard_dir}': '{DEFAULT_SHARD}' is reserved for PDFs placed directly in {pdf_dir}")
+                    continue
+                shard_pdfs[shard_name] = pdfs
+        return shard_pdfs
+
     def load_documents(self, pdf_dir="./pdfs"):
-        """Load all PDFs from a directory and create vector stores"""
+        """Load all PDFs from a directory and create one vector store per shard"""
         if not os.path.exists(pdf_dir):
             os.makedirs(pdf_dir)
             print(f"Created directory {pdf_dir}")
             return False
             
-        pdf_files = glob.glob(os.path.join(pdf_dir, "*.pdf"))
+        shard_pdfs = self.find_shard_pdfs(pdf_dir)
         
-        if not pdf_files:
+        if not shard_pdfs:
             print(f"No PDF files found in {pdf_dir}")
             return False
             
-        print(f"\nFound {len(pdf_files)} PDF files:")
-        for pdf in pdf_files:
-            print(f"- {os.path.basename(pdf)}")
+        print(f"\nFound {sum(len(p) for p in shard_pdfs.values())} PDF files in {len(shard_pdfs)} shards:")
+        for shard_name, pdfs in shard_pdfs.items():
+            print(f"- {shard_name}: {', '.join(os.path.basename(p) for p in pdfs)}")
             
-        all_docs = []
         self.embeddings = HuggingFaceEmbeddings(model_name="all-MiniLM-L6-v2")
         
-        for pdf_path in pdf_files:
+        # Every index is rebuilt below, so drop whatever a previous run left on disk
+        self.documents.clear()
+        
+        for shard_name, pdfs in shard_pdfs.items():
+            self.build_shard(shard_name, pdfs)
+        
+        return True
+    
+    def build_shard(self, shard_name, pdf_paths):
+        """(Re)build a single shard and the per-document stores of its PDFs.
+
+        Chunks are embedded once and the vectors reused for both the
+        per-document stores and the shard store.
+        """
+        print(f"\nBuilding shard '{shard_name}'...")
+        splitter = RecursiveCharacterTextSplitter(chunk_size=300, chunk_overlap=30)
+        shard_embeddings = []
+        shard_metadatas = []
+        doc_names = []
+        
+        for pdf_path in pdf_paths:
             doc_name = os.path.basename(pdf_path)
-            print(f"\nProcessing {doc_name}...")
+            print(f"Processing {doc_name}...")
             
             # Load and split document
             loader = PyPDFLoader(pdf_path)
             docs = loader.load()
             
-            # Add document source to metadata
+            # Add document source and shard to metadata
             for doc in docs:
                 doc.metadata["source_file"] = doc_name
+                doc.metadata["shard"] = shard_name
             
-            splitter = RecursiveCharacterTextSplitter(chunk_size=300, chunk_overlap=30)
             chunks = splitter.split_documents(docs)
+            texts = [chunk.page_content for chunk in chunks]
+            metadatas = [chunk.metadata for chunk in chunks]
+            text_embeddings = list(zip(texts, self.embeddings.embed_documents(texts)))
             
-            # Store individual document vectorstore
-            self.documents[doc_name] = FAISS.from_documents(chunks, embedding=self.embeddings)
+            # Persist individual document vectorstore; it is loaded back on first use
+            self.documents.save(document_key(shard_name, doc_name), FAISS.from_embeddings(text_embeddings, self.embeddings, metadatas=metadatas))
             
-            # Collect all chunks for combined vectorstore
-            all_docs.extend(chunks)
+            # Collect all chunks for the shard vectorstore
+            shard_embeddings.extend(text_embeddings)
+            shard_metadatas.extend(metadatas)
+            doc_names.append(doc_name)
         
-        # Create combined vectorstore
-        print("\nCreating combined vector store...")
-        self.combined_vectorstore = FAISS.from_documents(all_docs, embedding=self.embeddings)
+        # Drop per-document stores of PDFs that left this shard
+        for old_name in self.shard_documents.get(shard_name, []):
+            if old_name not in doc_names:
+                self.documents.remove(document_key(shard_name, old_name))
         
+        self.shards[shard_name] = FAISS.from_embeddings(shard_embeddings, self.embeddings, metadatas=shard_metadatas)
+        self.shard_documents[shard_name] = doc_names
+        print(f"Shard '{shard_name}' ready: {len(doc_names)} documents, {len(shard_embeddings)} chunks")
+    
+    def rebuild_shard(self, shard_name, pdf_dir="./pdfs"):
+        """Re-read the PDFs of one shard from disk without touching the other shards"""
+        if self.embeddings is None:
+            self.embeddings = HuggingFaceEmbeddings(model_name="all-MiniLM-L6-v2")
+        
+        pdfs = self.find_shard_pdfs(pdf_dir).get(shard_name)
+        if not pdfs:
+            # Shard removed from disk: drop it
+            for doc_name in self.shard_documents.pop(shard_name, []):
+                self.documents.remove(document_key(shard_name, doc_name))
+            self.shards.pop(shard_name, None)
+            return False
+        
+        self.build_shard(shard_name, pdfs)
         return True
     
     def get_document_names(self):
-        """Get list of loaded document names"""
-        return list(self.documents.keys())
+        """Get list of loaded document names ('shard/file.pdf' outside the general shard)"""
+        return self.documents.names()
+    
+    def _load_index(self, path):
+        """Load a per-document index saved by build_shard"""
+        # These files are written by this process, so unpickling them is safe
+        return FAISS.load_local(path, self.embeddings, allow_dangerous_deserialization=True)
+    
+    def get_index_residency(self):
+        """Get which per-document indexes are in memory and how much they use"""
+        return self.documents.stats()
+    
+    def get_shard_info(self):
+        """Get shard name -> document names and chunk count"""
+        return {
+            shard_name: {
+                "documents": self.shard_documents.get(shard_name, []),
+                "chunks": store.index.ntotal,
+            }
+            for shard_name, store in self.shards.items()
+        }
     
     def get_vectorstore(self, doc_name=None):
-        """Get vectorstore for a specific document or combined store"""
+        """Get vectorstore for a specific document (None means search all shards)"""
         if doc_name is None:
-            return self.combined_vectorstore
+            return None
+        if doc_name not in self.documents:
+            # Accept a bare file name when only one shard has it
+            matches = [key for key in self.documents.names() if key.endswith(f"/{doc_name}")]
+            if len(matches) > 1:
+                raise ValueError(f"Document '{doc_name}' exists in several shards, use one of: {', '.join(matches)}")
+            if matches:
+                doc_name = matches[0]
         return self.documents.get(doc_name)
     
+    def search(self, query, k=2, shards=None, metadata_filter=None):
+        """Search the given shards (all by default) in parallel and merge the top-k chunks"""
+        # Snapshot the stores: a concurrent rebuild may replace or drop shards meanwhile
+        all_stores = dict(self.shards)
+        shard_names = list(all_stores.keys()) if shards is None else shards
+        unknown = [name for name in shard_names if name not in all_stores]
+        if unknown:
+            raise ValueError(f"Shard(s) not found: {', '.join(unknown)}")
+        
+        if metadata_filter and set(metadata_filter) == {"source_file"}:
+            # Only a file filter: search that document's own index in each shard that has it
+            source_file = metadata_filter["source_file"]
+            stores = {}
+            for name in shard_names:
+                if source_file in self.shard_documents.get(name, []):
+                    store = self.documents.get(document_key(name, source_file))
+                    if store is not None:
+                        stores[name] = store
+            metadata_filter = None
+        else:
+            stores = {name: all_stores[name] for name in shard_names}
+            # Skip shards that cannot match a source_file filter
+            if metadata_filter and "source_file" in metadata_filter:
+                stores = {
+                    name: store for name, store in stores.items()
+                    if metadata_filter["source_file"] in self.shard_documents.get(name, [])
+                }
+        if not stores:
+            return []
+        
+        # Embed once, then scatter the vector to every shard
+        query_embedding = self.embeddings.embed_query(query)
+        
+        def search_store(store):
+            if metadata_filter:
+                return _filtered_search(store, query_embedding, k, metadata_filter)
+            return store.similarity_search_with_score_by_vector(query_embedding, k=k)
+        
+        scored = []
+        for results in self.search_pool.map(search_store, stores.values()):
+            scored.extend(results)
+        
+        # FAISS returns L2 distances: lower is closer
+        scored.sort(key=lambda pair: pair[1])
+        return [doc for doc, _ in scored[:k]]
+    
     def create_company_name_engineer_prompt(self):
         """Create a custom prompt for COMPANY_NAME chemical engineer persona"""
         template = """Eres un ingeniero químico experimentado de COMPANY_NAME especializado en alertas de incidentes y respuestas rápidas.
@@ -123,50 +310,38 @@ Respuesta breve y específica como ingeniero de COMPANY_NAME (en español):"""
             input_variables=["context", "question"]
         )
     
-    def create_qa_chain(self, doc_name=None, streaming=True, temperature=0.1):
-        """Create a QA chain for a specific document or all documents"""
-        if self.llm is None:
-            self.setup_llm(streaming=streaming, temperature=temperature)
-            
+    def create_retriever(self, doc_name=None, shards=None, metadata_filter=None, k=2):
+        """Create a retriever for a specific document or for a set of shards"""
+        if doc_name is None:
+            if not self.shards:
+                raise ValueError("No documents loaded")
+            return ShardedRetriever(manager=self, shards=shards, metadata_filter=metadata_filter, k=k)
+        
         vectorstore = self.get_vectorstore(doc_name)
         if vectorstore is None:
             raise ValueError(f"Document '{doc_name}' not found")
-        
-        # Create custom prompt for COMPANY_NAME engineer persona
-        custom_prompt = self.create_company_name_engineer_prompt()
-            
-        return RetrievalQA.from_chain_type(
-            llm=self.llm,
-            retriever=vectorstore.as_retriever(search_kwargs={"k": 2}),
-            chain_type="stuff",
-            return_source_documents=True,
-            chain_type_kwargs={"prompt": custom_prompt}
-        )
+        search_kwargs = {"k": k}
+        if metadata_filter:
+            search_kwargs["filter"] = metadata_filter
+            search_kwargs["fetch_k"] = max(k, vectorstore.index.ntotal)
+        return vectorstore.as_retriever(search_kwargs=search_kwargs)
     
-    def query_document(self, query, doc_name=None, streaming=True, temperature=0.1):
-        """Query a specific document or all documents"""
-        print("\n=== Document Manager Query ===")
-        print(f"Received query: {query}")
-        print(f"Document name: {doc_name}")
-        print(f"Streaming: {streaming}")
-        print(f"Temperature: {temperature}")
-        
-        try:
-            print("\nCreating QA chain...")
-            qa_chain = self.create_qa_chain(doc_name, streaming, temperature)
-            print("QA chain created successfully")
-            
-            print("\nInvoking QA chain...")
-            result = qa_chain.invoke({"query": query})
-            print("QA chain invoked successfully")
-            
-            print(f"\nResult: {result}")
-            return result
-            
-        except Exception as e:
-            print(f"\nError in query_document: {str(e)}")
-            print(f"Error type: {type(e)}")
-            return {"error": str(e)}
+    def retrieve(self, query, doc_name=None, shards=None, metadata_filter=None, k=2):
+        """Retrieve the chunks a query would be answered from, without calling the LLM"""
+        return self.create_retriever(doc_name, shards, metadata_filter, k).invoke(query)
+    
+    def answer_from_documents(self, query, source_documents, streaming=True, temperature=0.1):
+        """Run the LLM over already retrieved chunks with the engineer prompt.
+
+        Errors are raised so callers can tell LLM failures apart from
+        retrieval errors.
+        """
+        if self.llm is None:
+            self.setup_llm(streaming=streaming, temperature=temperature)
+        
+        chain = load_qa_chain(self.llm, chain_type="stuff", prompt=self.create_company_name_engineer_prompt())
+        output = chain.invoke({"input_documents": source_documents, "question": query})
+        return {"query": query, "result": output["output_text"], "source_documents": source_documents}
 
 def format_sources(source_documents):
     """Format source documents for display"""
@@ -179,4 +354,14 @@ def format_sources(source_documents):
             "excerpt": doc.page_content[:200]
         }
         sources.append(source)
-    return sources
\ No newline at end of file
+    return sources
+
+def build_extractive_answer(source_documents):
+    """Build a degraded answer from the retrieved chunks when the LLM is not available"""
+    lines = ["⚠️ Respuesta degradada: el asistente no está disponible en este momento. Fragmentos relevantes de los documentos:"]
+    for source in format_sources(source_documents):
+        excerpt = " ".join(source["excerpt"].split())
+        lines.append(f"• ({source['document']}, pág. {source['page']}) {excerpt}")
+    if not source_documents:
+        lines.append("• No se encontraron fragmentos relevantes. Siga el protocolo de emergencia de la planta.")
+    return "\n".join(lines)
@@ -0,0 +1,183 @@
+from collections import OrderedDict
+import os
+import shutil
+import threading
+import time
+import uuid
+
+
+def _folder_size(path):
+    """Bytes used on disk by a saved index folder (proxy for its resident size)"""
+    total = 0
+    for entry in os.scandir(path):
+        if entry.is_file():
+            total += entry.stat().st_size
+    return total
+
+
+class IndexCache:
+    """Per-document FAISS indexes persisted to disk and loaded on first use.
+
+    Resident indexes are kept in LRU order and evicted when the total size
+    goes over `budget_bytes`. An index bigger than the whole budget is still
+    loaded (everything else is evicted) so queries against it keep working.
+    """
+
+    def __init__(self, index_dir, budget_bytes, loader):
+        self.index_dir = index_dir
+        self.budget_bytes = budget_bytes
+        self.loader = loader  # callable(path) -> vectorstore
+        self.paths = {}  # name -> folder on disk
+        self.resident = OrderedDict()  # name -> (vectorstore, size_bytes, last_used)
+        self.used_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+
+    def _path_for(self, name):
+        return os.path.join(self.index_dir, name)
+
+    def clear(self):
+        """Forget every index and delete the folders this cache wrote to index_dir.
+
+        Only index folders (containing index.faiss) and leftover .tmp-/.old-
+        folders are removed: index_dir may be a shared directory.
+        """
+        with self._load_lock:
+            with self._lock:
+                self.paths.clear()
+                self.resident.clear()
+                self.used_bytes = 0
+            os.makedirs(self.index_dir, exist_ok=True)
+            for folder in self._owned_folders():
+                shutil.rmtree(folder, ignore_errors=True)
+                # Remove shard subfolders left empty, but never index_dir itself
+                parent = os.path.dirname(folder)
+                while os.path.abspath(parent) != os.path.abspath(self.index_dir):
+                    try:
+                        os.rmdir(parent)
+                    except OSError:
+                        break
+                    parent = os.path.dirname(parent)
+
+    def _owned_folders(self):
+        """Folders under index_dir written by save(): indexes and interrupted swaps"""
+        owned = []
+        root_dir = os.path.abspath(self.index_dir)
+        for root, dirs, files in os.walk(self.index_dir):
+            name = os.path.basename(root)
+            if os.path.abspath(root) == root_dir:
+                continue
+            if "index.faiss" in files or ".tmp-" in name or ".old-" in name:
+                owned.append(root)
+                dirs[:] = []  # don't descend into a folder that is deleted as a whole
+        return owned
+
+    def save(self, name, vectorstore):
+        """Persist an index to disk; it becomes resident only on first use"""
+        path = self._path_for(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write next to the final folder, then swap it in so a load never sees a half-written index
+        tmp_path = f"{path}.tmp-{uuid.uuid4().hex}"
+        vectorstore.save_local(tmp_path)
+        with self._load_lock:
+            old_path = None
+            if os.path.isdir(path):
+                old_path = f"{path}.old-{uuid.uuid4().hex}"
+                os.rename(path, old_path)
+            os.rename(tmp_path, path)
+            with self._lock:
+                self.paths[name] = path
+                self._drop(name)
+        if old_path:
+            shutil.rmtree(old_path)
+
+    def remove(self, name):
+        """Forget an index and delete it from disk"""
+        with self._load_lock:
+            with self._lock:
+                path = self.paths.pop(name, None)
+                self._drop(name)
+            if path and os.path.isdir(path):
+                shutil.rmtree(path)
+
+    def names(self):
+        return list(self.paths.keys())
+
+    def __contains__(self, name):
+        return name in self.paths
+
+    def get(self, name):
+        """Return the index for `name`, loading it from disk if needed (None if unknown)"""
+        with self._lock:
+            if name in self.resident:
+                return self._touch(name)
+            if name not in self.paths:
+                return None
+
+        # Serialize loads so the same index is not read twice concurrently
+        with self._load_lock:
+            with self._lock:
+                if name in self.resident:
+                    return self._touch(name)
+                path = self.paths.get(name)
+            if path is None:
+                return None
+
+            print(f"Loading index '{name}' from {path}")
+            vectorstore = self.loader(path)
+            size = _folder_size(path)
+
+            with self._lock:
+                self.misses += 1
+                self._make_room(size)
+                self.resident[name] = (vectorstore, size, time.time())
+                self.used_bytes += size
+            return vectorstore
+
+    def _touch(self, name):
+        vectorstore, size, _ = self.resident.pop(name)
+        self.resident[name] = (vectorstore, size, time.time())
+        self.hits += 1
+        return vectorstore
+
+    def _drop(self, name):
+        entry = self.resident.pop(name, None)
+        if entry is not None:
+            self.used_bytes -= entry[1]
+
+    def _make_room(self, size):
+        """Evict least recently used indexes until `size` more bytes fit in the budget"""
+        while self.resident and self.used_bytes + size > self.budget_bytes:
+            name, (_, evicted_size, _) = self.resident.popitem(last=False)
+            self.used_bytes -= evicted_size
+            self.evictions += 1
+            print(f"Evicted index '{name}' ({evicted_size} bytes)")
+
+    def _scan_disk(self):
+        """Index folders actually present in index_dir"""
+        found = []
+        for root, _, files in os.walk(self.index_dir):
+            if "index.faiss" in files:
+                found.append(os.path.relpath(root, self.index_dir).replace(os.sep, "/"))
+        return sorted(found)
+
+    def stats(self):
+        """Which indexes are resident, their size and the cache counters"""
+        on_disk = self._scan_disk()
+        with self._lock:
+            return {
+                "budget_bytes": self.budget_bytes,
+                "used_bytes": self.used_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "resident": [
+                    {"name": name, "size_bytes": size, "last_used": last_used}
+                    for name, (_, size, last_used) in reversed(self.resident.items())
+                ],
+                "known": sorted(self.paths.keys()),
+                "on_disk": on_disk,
+            }
@@ -0,0 +1,45 @@
+from collections import deque
+import threading
+
+
+def _pick(ordered, pct):
+    """Nearest-rank percentile over an already sorted list"""
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+class LatencyWindow:
+    """Keep the last N latency samples (in seconds) and summarize them"""
+
+    def __init__(self, max_samples=1000):
+        self.samples = deque(maxlen=max_samples)
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def record(self, seconds):
+        """Add a latency sample"""
+        with self._lock:
+            self.samples.append(seconds)
+            self.count += 1
+
+    def percentile(self, pct):
+        """Return the given percentile (0-100) of the current window, in seconds"""
+        with self._lock:
+            ordered = sorted(self.samples)
+        return _pick(ordered, pct) if ordered else 0.0
+
+    def summary(self):
+        """Summary in milliseconds, ready to be returned as JSON"""
+        with self._lock:
+            ordered = sorted(self.samples)
+            count = self.count
+        if not ordered:
+            return {"count": count, "p50_ms": 0.0, "p95_ms": 0.0, "p99_ms": 0.0, "max_ms": 0.0}
+
+        return {
+            "count": count,
+            "p50_ms": round(_pick(ordered, 50) * 1000, 1),
+            "p95_ms": round(_pick(ordered, 95) * 1000, 1),
+            "p99_ms": round(_pick(ordered, 99) * 1000, 1),
+            "max_ms": round(ordered[-1] * 1000, 1),
+        }
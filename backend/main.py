@@ -1,9 +1,17 @@
-from fastapi import FastAPI, HTTPException, Request
+from fastapi import BackgroundTasks, FastAPI, HTTPException, Request
 from fastapi.responses import Response
 from fastapi.middleware.cors import CORSMiddleware
-from document_manager import DocumentManager, format_sources
+from fastapi.concurrency import run_in_threadpool
+from document_manager import DocumentManager, build_extractive_answer, format_sources
+from request_scheduler import RequestScheduler, SchedulerRejected
+from llm_guard import LLM_TIMEOUT_S, CircuitBreaker
+from latency_stats import LatencyWindow
 from report_generator import ReportGenerator
+from traffic_capture import TrafficCaptureMiddleware
+from collections import Counter
+import asyncio
 import json
+import time
 import os
 import mail_sender
 import urllib.parse
@@ -26,16 +34,95 @@ app.add_middleware(
 # Initialize document manager
 doc_manager = DocumentManager()
 
+# Admission control in front of the LLM (emergencies first)
+scheduler = RequestScheduler()
+
+# Stop calling Ollama while it keeps failing or timing out. The threshold must not
+# exceed the LLM slots, or hung calls could fill every slot before the breaker opens.
+llm_breaker = CircuitBreaker(failure_threshold=min(3, scheduler.total_slots))
+
+# Tail-latency statistics for /query, per outcome
+query_latency = {outcome: LatencyWindow() for outcome in ("ok", "degraded", "rejected", "error")}
+llm_latency = LatencyWindow()
+degraded_reasons = Counter()
+
+# Opt-in capture of /query and /generate-report traffic (replay with replay_traffic.py)
+TRAFFIC_CAPTURE_PATH = os.environ.get("TRAFFIC_CAPTURE_PATH")
+if TRAFFIC_CAPTURE_PATH:
+    app.add_middleware(
+        TrafficCaptureMiddleware,
+        log_path=TRAFFIC_CAPTURE_PATH,
+        mode=os.environ.get("TRAFFIC_CAPTURE_MODE", "hash"),
+        classify=scheduler.classify,
+    )
+
 # Configuration
 FRONTEND_PORT = 3000
 
+# Default /query deadline per priority class (overridable with "deadline_ms")
+QUERY_DEADLINES_S = {"emergencia": 15.0, "consulta": 45.0}
+
 def generate_context_url(message: str) -> str:
     """Generate a URL with the LLM response encoded as a parameter"""
     encoded_message = urllib.parse.quote(message)
     context_url = f"http://localhost:{FRONTEND_PORT}?data={encoded_message}"
     return context_url
 
+async def generate_within_deadline(priority, query_text, source_documents, temperature, deadline):
+    """Run the LLM over the retrieved chunks inside a scheduler slot, giving up at `deadline`.
+
+    Returns (result, degraded_reason); result is None when an extractive
+    answer must be returned instead. A generation that misses the deadline
+    keeps its slot until Ollama finishes, so a slow LLM is not piled on.
+    The breaker only judges the LLM call itself (LLM_TIMEOUT_S from its
+    start), never queue wait or a short client deadline.
+    Raises SchedulerRejected when the request is not admitted.
+    """
+    if llm_breaker.is_open():
+        return None, "circuit_open"
 
+    admitted = asyncio.Event()
+
+    async def generate():
+        async with scheduler.slot(priority, deadline=deadline):
+            admitted.set()
+            if not llm_breaker.allow():
+                return None, "circuit_open"
+            started = time.monotonic()
+            call = asyncio.ensure_future(run_in_threadpool(
+                doc_manager.answer_from_documents, query_text, source_documents, False, temperature
+            ))
+            try:
+                result = await asyncio.wait_for(asyncio.shield(call), timeout=LLM_TIMEOUT_S)
+            except asyncio.TimeoutError:
+                llm_breaker.record_failure()
+                # Hold the slot until Ollama finishes; its late result is discarded
+                await asyncio.wait({call})
+                call.exception()
+                return None, "llm_timeout"
+            except Exception as e:
+                print(f"\nLLM error: {str(e)}")
+                llm_breaker.record_failure()
+                return None, "llm_error"
+            finally:
+                llm_latency.record(time.monotonic() - started)
+            llm_breaker.record_success()
+            return result, None
+
+    task = asyncio.ensure_future(generate())
+
+    # Queue wait is bounded by the scheduler itself (503 when the deadline passes)
+    admitted_wait = asyncio.ensure_future(admitted.wait())
+    await asyncio.wait({task, admitted_wait}, return_when=asyncio.FIRST_COMPLETED)
+    admitted_wait.cancel()
+    if task.done():
+        return task.result()
+
+    try:
+        return await asyncio.wait_for(asyncio.shield(task), timeout=max(0.0, deadline - time.monotonic()))
+    except asyncio.TimeoutError:
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())  # result no longer needed
+        return None, "deadline"
 
 @app.on_event("startup")
 async def startup_event():
@@ -55,10 +142,44 @@ async def health_check():
 async def read_item(item_id: int, q: str = None):
     return {"item_id": item_id, "q": q} 
 
+@app.get("/scheduler/stats")
+async def scheduler_stats():
+    """Queue depth, shedding counters and queue-wait time per priority class"""
+    return scheduler.stats()
+
+@app.get("/query/stats")
+async def query_stats():
+    """Tail latency of /query per outcome (ok, degraded, rejected, error), LLM latency and breaker state"""
+    return {
+        "latency": {outcome: window.summary() for outcome, window in query_latency.items()},
+        "llm_latency": llm_latency.summary(),
+        "degraded_reasons": dict(degraded_reasons),
+        "circuit_breaker": llm_breaker.stats(),
+    }
+
+@app.get("/documents/indexes")
+async def document_indexes():
+    """Show which per-document indexes are resident in memory and their size"""
+    return doc_manager.get_index_residency()
+
+@app.get("/shards")
+async def list_shards():
+    """List loaded shards (one per plant/collection) with their documents"""
+    return {"shards": doc_manager.get_shard_info()}
+
+@app.post("/shards/{shard_name}/rebuild")
+async def rebuild_shard(shard_name: str):
+    """Re-read one shard's PDFs from disk without re-embedding the others"""
+    if not await run_in_threadpool(doc_manager.rebuild_shard, shard_name):
+        raise HTTPException(status_code=404, detail=f"No PDFs found for shard '{shard_name}'")
+    return {"shard": shard_name, **doc_manager.get_shard_info()[shard_name]}
+
 ##PRUEBA USO DE RAG HANDLER
 @app.post("/query")
-async def query_documents(request: Request):
-    """Query documents and get response"""
+async def query_documents(request: Request, background_tasks: BackgroundTasks):
+    """Query documents and get response (extractive and degraded if the LLM misses the deadline)"""
+    started = time.monotonic()
+    outcome = "error"  # until the request is answered or rejected
     try:
         # Get raw request data
         data = await request.json()
@@ -75,25 +196,75 @@ async def query_documents(request: Request):
         query_text = str(data["text"])
         doc_name = data.get("document_name")
         temperature = data.get("temperature", 0.1)  # Default: very cold/deterministic
+        shards = data.get("shards")  # Plant/collection shards to search (default: all)
+        metadata_filter = data.get("filters")  # Exact-match metadata filters, e.g. {"source_file": "..."}
+        deadline_ms = data.get("deadline_ms")  # Overrides the per-priority default deadline
 
         if not query_text.strip():
             raise HTTPException(status_code=400, detail="'text' field cannot be empty")
 
+        if isinstance(shards, str):
+            shards = [shards]
+        if shards is not None and not isinstance(shards, list):
+            raise HTTPException(status_code=400, detail="'shards' must be a string or a list of strings")
+        if metadata_filter is not None and not isinstance(metadata_filter, dict):
+            raise HTTPException(status_code=400, detail="'filters' must be a JSON object")
+        if deadline_ms is not None and (not isinstance(deadline_ms, (int, float)) or deadline_ms <= 0):
+            raise HTTPException(status_code=400, detail="'deadline_ms' must be a positive number")
+
         print(f"\nProcessing query:")
         print(f"text: {query_text}")
         print(f"document_name: {doc_name}")
         print(f"temperature: {temperature}")
+        print(f"shards: {shards}")
+        print(f"filters: {metadata_filter}")
 
-        # Query the document
-        result = doc_manager.query_document(
-            query=query_text,
-            doc_name=doc_name,
-            streaming=False,
-            temperature=temperature,
-        )
+        # Classify before generation so urgent incidents don't wait behind chit-chat
+        priority = scheduler.classify(query_text)
+        deadline = started + (deadline_ms / 1000 if deadline_ms is not None else QUERY_DEADLINES_S[priority])
+        print(f"priority: {priority}")
+        print(f"deadline: {deadline - started:.1f}s")
 
-        if "error" in result:
-            raise HTTPException(status_code=400, detail=result["error"])
+        # A full queue means a 429 anyway: don't spend an embedding and a search on it
+        if priority != scheduler.top_priority:
+            scheduler.check_queue(priority)
+
+        # Retrieve first: its chunks are the fallback if the LLM is late. It is bounded
+        # by the deadline too, since it may have to load a per-document index from disk.
+        try:
+            source_documents = await asyncio.wait_for(
+                run_in_threadpool(
+                    doc_manager.retrieve,
+                    query_text,
+                    doc_name=doc_name,
+                    shards=shards,
+                    metadata_filter=metadata_filter,
+                ),
+                timeout=max(0.0, deadline - time.monotonic()),
+            )
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        except asyncio.TimeoutError:
+            source_documents = None
+
+        if source_documents is None:
+            source_documents = []
+            result, degraded_reason = None, "retrieval_timeout"
+        else:
+            try:
+                result, degraded_reason = await generate_within_deadline(
+                    priority, query_text, source_documents, temperature, deadline
+                )
+            except SchedulerRejected as e:
+                # Chit-chat is shed (429/503); an emergency always gets at least the extractive answer
+                if priority != scheduler.top_priority:
+                    raise
+                result, degraded_reason = None, "queue_full" if e.status_code == 429 else "queue_timeout"
+
+        if result is None:
+            print(f"\n⚠️ Respuesta degradada ({degraded_reason}) - devolviendo fragmentos recuperados")
+            degraded_reasons[degraded_reason] += 1
+            result = {"result": build_extractive_answer(source_documents), "source_documents": source_documents}
 
         # Generate context URL with full response
         answer_text = str(result["result"])
@@ -108,17 +279,24 @@ async def query_documents(request: Request):
         response = {
             "answer": answer_text,
             "sources": format_sources(result["source_documents"]),
-            "context_url": context_url
+            "context_url": context_url,
+            "priority": priority,
+            "degraded": degraded_reason is not None,
+            "degraded_reason": degraded_reason
         }
         
-        # Only send email for alert/incident scenarios (when answer contains "Alerta" or "Protocolo")
-        if "alerta" in answer_text.lower() or "protocolo" in answer_text.lower() or "emergencia" in answer_text.lower():
-            print("🚨 Detectada alerta/protocolo de emergencia - Enviando email")
-            mail_res = mail_sender.enviar_correo(query_text, context_url)
-            print(f"Email sent successfully: {mail_res}")
+        # Only send email for alert/incident scenarios (when answer contains "Alerta" or "Protocolo").
+        # Emails go out in the background after the response, so SMTP never blocks the event loop.
+        if degraded_reason is not None:
+            # The extractive answer quotes the manuals, so rely on the query classification
+            if priority == scheduler.top_priority:
+                print("🚨 Emergencia con respuesta degradada - Enviando email en segundo plano")
+                background_tasks.add_task(mail_sender.enviar_correo, query_text, context_url)
+        elif "alerta" in answer_text.lower() or "protocolo" in answer_text.lower() or "emergencia" in answer_text.lower():
+            print("🚨 Detectada alerta/protocolo de emergencia - Enviando email en segundo plano")
+            background_tasks.add_task(mail_sender.enviar_correo, query_text, context_url)
         else:
             print("💬 Consulta normal - No se envía email")
-            mail_res = True  # No error for normal queries
         print("\n=== Processed Query ===")
 
         print("\n=== Response Data ===")
@@ -126,13 +304,27 @@ async def query_documents(request: Request):
         print(f"\n=== Context URL Generated ===")
         print(f"URL: {context_url}")
         
+        outcome = "degraded" if degraded_reason else "ok"
         return response
 
+    except SchedulerRejected as e:
+        outcome = "rejected"
+        print(f"\n⏳ Request rejected by scheduler ({e.status_code}): {e.detail}")
+        raise HTTPException(
+            status_code=e.status_code,
+            detail=e.detail,
+            headers={"Retry-After": str(e.retry_after)} if e.retry_after else None,
+        )
+    except HTTPException:
+        raise
     except json.JSONDecodeError:
         raise HTTPException(status_code=400, detail="Invalid JSON in request body")
     except Exception as e:
         print(f"\nError processing request: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        # Every request counts, so shed and failed requests can't hide the tail
+        query_latency[outcome].record(time.monotonic() - started)
 
 @app.post("/generate-report")
 async def generate_report(request: Request):
@@ -0,0 +1,300 @@
+"""Replay traffic captured by TrafficCaptureMiddleware and compare two builds.
+
+Capture (in the running service):
+    TRAFFIC_CAPTURE_PATH=traffic.jsonl uvicorn main:app
+
+Replay against a build, in-process with local stand-ins for Ollama and SMTP
+(point --app-dir to a checkout of each build, e.g. made with `git worktree`):
+    python replay_traffic.py run traffic.jsonl --app-dir ../old/backend --label old --out old.json --speed 4
+    python replay_traffic.py run traffic.jsonl --app-dir . --label new --out new.json --speed 4
+
+Compare latency distribution, throughput and error rate:
+    python replay_traffic.py compare old.json new.json
+
+`--url` replays against an already running server instead (no stand-ins).
+"""
+from latency_stats import LatencyWindow
+from collections import Counter
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+
+# Words used to rebuild hashed query text with the same length and priority class
+FILLER_WORDS = [
+    "consulta", "sobre", "el", "procedimiento", "de", "trasvase", "del", "tanque",
+    "en", "la", "planta", "con", "metacrilato", "y", "equipo", "cisterna", "operario",
+]
+EMERGENCY_WORD = "Alerta:"
+
+STAND_IN_ANSWER = "Respuesta simulada: verifique el EPP y siga el procedimiento del manual."
+
+
+def load_records(log_path):
+    """Read a capture log, oldest request first"""
+    records = []
+    with open(log_path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                records.append(json.loads(line))
+    records.sort(key=lambda r: r["t"])
+    return records
+
+
+def synthesize_text(text_info, priority=None):
+    """Return the captured text, or a stand-in of the same size for hashed text"""
+    if isinstance(text_info, str):
+        return text_info
+    rng = random.Random(text_info.get("sha", ""))
+    words = [rng.choice(FILLER_WORDS) for _ in range(max(1, text_info.get("words", 1)))]
+    if priority == "emergencia":
+        words[0] = EMERGENCY_WORD
+    return " ".join(words)
+
+
+def build_request_body(record):
+    """Turn a captured (scrubbed) body back into a request body"""
+    body = dict(record["body"])
+    if body.get("invalid"):
+        return None
+    if record["path"] == "/query":
+        priority = body.pop("priority", None)
+        if "text" in body:
+            body["text"] = synthesize_text(body["text"], priority)
+        return body
+    if record["path"] == "/generate-report":
+        conversation = body.get("conversation")
+        if not isinstance(conversation, dict) or conversation.get("messages") is None:
+            # Malformed body as captured: replay it as-is
+            return {"conversation": conversation}
+        messages = [
+            {**msg, "content": synthesize_text(msg.get("content", ""))}
+            for msg in conversation.get("messages", [])
+        ]
+        return {"conversation": {"messages": messages}}
+    return body
+
+
+class StandInSMTP:
+    """Accepts every email without touching the network"""
+
+    sent = 0
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def starttls(self, *args, **kwargs):
+        pass
+
+    def login(self, *args, **kwargs):
+        pass
+
+    def sendmail(self, from_addr, to_addrs, msg, *args, **kwargs):
+        StandInSMTP.sent += 1
+        return {}
+
+    def quit(self):
+        pass
+
+
+def make_stand_in_llm(latency_s):
+    """Chat model that answers after a fixed delay, in place of Ollama"""
+    from langchain_core.language_models.fake_chat_models import FakeListChatModel
+
+    class StandInChatModel(FakeListChatModel):
+        latency_s: float = 0.0
+
+        def _call(self, *args, **kwargs):
+            time.sleep(self.latency_s)
+            return super()._call(*args, **kwargs)
+
+    return StandInChatModel(responses=[STAND_IN_ANSWER], latency_s=latency_s)
+
+
+async def start_in_process_app(app_dir, llm_latency_s):
+    """Import the build in `app_dir`, run its startup and swap in the stand-ins"""
+    import smtplib
+
+    smtplib.SMTP = StandInSMTP
+
+    app_dir = os.path.abspath(app_dir)
+    sys.path.insert(0, app_dir)
+    os.chdir(app_dir)  # the app loads ./pdfs relative to the working directory
+    import main
+
+    await main.app.router.startup()
+    main.doc_manager.llm = make_stand_in_llm(llm_latency_s)
+    return main.app
+
+
+async def replay(records, client, speed):
+    """Re-issue the captured requests keeping their spacing, divided by `speed`"""
+    first_t = records[0]["t"]
+    start = time.monotonic()
+    results = []
+
+    async def fire(record):
+        await asyncio.sleep(max(0.0, (record["t"] - first_t) / speed - (time.monotonic() - start)))
+        body = build_request_body(record)
+        sent = time.monotonic()
+        degraded = False
+        try:
+            if body is None:
+                response = await client.request(record["method"], record["path"], content=b"{")
+            else:
+                response = await client.request(record["method"], record["path"], json=body)
+            status = response.status_code
+            if record["path"] == "/query" and status == 200:
+                degraded = bool(response.json().get("degraded"))
+        except Exception as e:
+            print(f"Request to {record['path']} failed: {e}")
+            status = 0
+        results.append({
+            "path": record["path"],
+            "status": status,
+            "latency_s": time.monotonic() - sent,
+            "degraded": degraded,
+        })
+
+    await asyncio.gather(*(fire(record) for record in records))
+    return results, time.monotonic() - start
+
+
+def summarize(results, duration_s):
+    """Latency distribution, throughput and error rates of a replay"""
+
+    def rates(subset):
+        latency = LatencyWindow(max_samples=max(1, len(subset)))
+        for r in subset:
+            latency.record(r["latency_s"])
+        total = len(subset) or 1
+        errors = sum(1 for r in subset if not 200 <= r["status"] < 300)
+        shed = sum(1 for r in subset if r["status"] in (429, 503))
+        return {
+            "requests": len(subset),
+            "error_rate": round(errors / total, 4),
+            "shed_rate": round(shed / total, 4),
+            "degraded_rate": round(sum(1 for r in subset if r["degraded"]) / total, 4),
+            "statuses": dict(Counter(str(r["status"]) for r in subset)),
+            "latency": latency.summary(),
+        }
+
+    summary = rates(results)
+    summary["duration_s"] = round(duration_s, 3)
+    summary["throughput_rps"] = round(len(results) / duration_s, 3) if duration_s > 0 else 0.0
+    summary["by_path"] = {
+        path: rates([r for r in results if r["path"] == path])
+        for path in sorted({r["path"] for r in results})
+    }
+    return summary
+
+
+async def run_command(args):
+    records = load_records(args.log)
+    if not records:
+        print(f"No requests in {args.log}")
+        return 1
+
+    import httpx
+
+    out_path = os.path.abspath(args.out)
+    if args.url:
+        client = httpx.AsyncClient(base_url=args.url, timeout=args.timeout)
+        target = args.url
+    else:
+        target = os.path.abspath(args.app_dir)
+        app = await start_in_process_app(target, args.llm_latency_ms / 1000)
+        client = httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://replay", timeout=args.timeout)
+
+    print(f"\nReplaying {len(records)} requests against {target} at {args.speed}x...")
+    async with client:
+        results, duration_s = await replay(records, client, args.speed)
+
+    summary = {
+        "label": args.label or target,
+        "target": target,
+        "speed": args.speed,
+        "llm_latency_ms": None if args.url else args.llm_latency_ms,
+        "emails_sent": None if args.url else StandInSMTP.sent,
+        **summarize(results, duration_s),
+    }
+    with open(out_path, "w", encoding="utf-8") as f:
+        json.dump(summary, f, indent=2)
+
+    latency = summary["latency"]
+    print(f"✅ {summary['requests']} requests in {summary['duration_s']}s "
+          f"({summary['throughput_rps']} req/s), error rate {summary['error_rate']:.2%}")
+    print(f"   p50 {latency['p50_ms']}ms  p95 {latency['p95_ms']}ms  p99 {latency['p99_ms']}ms  max {latency['max_ms']}ms")
+    print(f"   Results written to {out_path}")
+    return 0
+
+
+def compare_command(args):
+    with open(args.baseline, encoding="utf-8") as f:
+        a = json.load(f)
+    with open(args.candidate, encoding="utf-8") as f:
+        b = json.load(f)
+
+    def metrics(summary):
+        rows = {
+            "throughput_rps": summary["throughput_rps"],
+            "error_rate": summary["error_rate"],
+            "shed_rate": summary["shed_rate"],
+            "degraded_rate": summary["degraded_rate"],
+        }
+        for key in ("p50_ms", "p95_ms", "p99_ms", "max_ms"):
+            rows[f"latency_{key}"] = summary["latency"][key]
+        for path, stats in summary["by_path"].items():
+            rows[f"{path} p95_ms"] = stats["latency"]["p95_ms"]
+            rows[f"{path} error_rate"] = stats["error_rate"]
+        return rows
+
+    a_rows, b_rows = metrics(a), metrics(b)
+    print(f"{'metric':<32}{a['label'][:16]:>18}{b['label'][:16]:>18}{'change':>12}")
+    for name in list(dict.fromkeys([*a_rows, *b_rows])):
+        a_val, b_val = a_rows.get(name), b_rows.get(name)
+        change = ""
+        if a_val is not None and b_val is not None:
+            change = f"{(b_val - a_val) / a_val:+.1%}" if a_val else f"{b_val - a_val:+g}"
+        print(f"{name:<32}{'-' if a_val is None else a_val:>18}{'-' if b_val is None else b_val:>18}{change:>12}")
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay captured /query and /generate-report traffic")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run = commands.add_parser("run", help="Replay a capture log and write a results file")
+    run.add_argument("log", help="Capture log written by TrafficCaptureMiddleware")
+    run.add_argument("--out", required=True, help="Where to write the results JSON")
+    run.add_argument("--label", help="Name of the build in the comparison")
+    run.add_argument("--speed", type=float, default=1.0, help="Speed multiplier (2 = twice as fast as captured)")
+    run.add_argument("--app-dir", default=".", help="Backend directory of the build to replay in-process")
+    run.add_argument("--url", help="Replay against a running server instead (no stand-ins)")
+    run.add_argument("--llm-latency-ms", type=float, default=500.0, help="Delay of the stand-in LLM")
+    run.add_argument("--timeout", type=float, default=120.0, help="Per-request timeout in seconds")
+
+    compare = commands.add_parser("compare", help="Compare the results of two builds")
+    compare.add_argument("baseline")
+    compare.add_argument("candidate")
+
+    args = parser.parse_args()
+    if args.command == "run" and args.speed <= 0:
+        parser.error("--speed must be positive")
+    if args.command == "run":
+        return asyncio.run(run_command(args))
+    return compare_command(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,192 @@
+from contextlib import asynccontextmanager
+from collections import deque
+from latency_stats import LatencyWindow
+import asyncio
+import re
+import time
+import unicodedata
+
+# Palabras que marcan una consulta como emergencia antes de llamar al LLM.
+# Se comparan palabras completas: "centrifuga" no contiene la palabra "fuga".
+# "protocolo" no está: también aparece en consultas de rutina ("protocolo de limpieza").
+EMERGENCY_KEYWORDS = {
+    "alerta", "emergencia", "incidente", "accidente",
+    "fuga", "derrame", "incendio", "fuego", "explosion", "evacuacion", "evacuar",
+    "intoxicacion", "inhalacion", "quemadura", "herido", "urgente",
+}
+
+# Total de llamadas simultáneas al LLM
+DEFAULT_TOTAL_SLOTS = 2
+
+# Configuración por clase, en orden de prioridad (la primera se atiende antes).
+# "consulta" nunca ocupa todos los slots para que una emergencia no espere detrás del chit-chat.
+DEFAULT_CLASSES = [
+    {"name": "emergencia", "max_concurrency": 2, "max_queue_depth": 50, "max_wait_s": 60.0},
+    {"name": "consulta", "max_concurrency": 1, "max_queue_depth": 10, "max_wait_s": 20.0},
+]
+
+
+class SchedulerRejected(Exception):
+    """Raised when a request is not admitted (queue full or deadline missed)"""
+
+    def __init__(self, status_code, detail, retry_after=None):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+        self.retry_after = retry_after
+
+
+def _normalize(text):
+    """Lowercase and strip accents so 'Evacuación' matches 'evacuacion'"""
+    decomposed = unicodedata.normalize("NFKD", text.lower())
+    return "".join(c for c in decomposed if not unicodedata.combining(c))
+
+
+def _is_emergency_word(word):
+    """Match a keyword or its plural ('fugas', 'explosiones')"""
+    return (word in EMERGENCY_KEYWORDS
+            or (word.endswith("s") and word[:-1] in EMERGENCY_KEYWORDS)
+            or (word.endswith("es") and word[:-2] in EMERGENCY_KEYWORDS))
+
+
+class _PriorityClass:
+    def __init__(self, name, max_concurrency, max_queue_depth, max_wait_s):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.max_queue_depth = max_queue_depth
+        self.max_wait_s = max_wait_s
+        self.queue = deque()  # pending futures, FIFO within the class
+        self.active = 0
+        self.admitted = 0
+        self.rejected_queue_full = 0
+        self.shed_deadline = 0
+        self.queue_wait = LatencyWindow()
+
+
+class RequestScheduler:
+    """Admission control in front of the LLM.
+
+    Requests are classified from the query text, wait in a bounded queue per
+    priority class and get an LLM slot in strict priority order, respecting
+    each class' concurrency limit. A full queue is rejected with 429 and a
+    request that cannot start before its deadline is shed with 503.
+    """
+
+    def __init__(self, total_slots=DEFAULT_TOTAL_SLOTS, classes=None):
+        self.total_slots = total_slots
+        self.classes = [_PriorityClass(**cfg) for cfg in (classes or DEFAULT_CLASSES)]
+        self._by_name = {c.name: c for c in self.classes}
+        self.active_total = 0
+
+    @property
+    def top_priority(self):
+        """Name of the highest priority class"""
+        return self.classes[0].name
+
+    def classify(self, query_text):
+        """Return the priority class name for a query"""
+        words = re.findall(r"[a-z0-9]+", _normalize(query_text))
+        if any(_is_emergency_word(word) for word in words):
+            return self.top_priority
+        return self.classes[-1].name
+
+    def _dispatch(self):
+        """Hand free slots to waiting requests, highest priority first"""
+        for pclass in self.classes:
+            while (pclass.queue
+                   and self.active_total < self.total_slots
+                   and pclass.active < pclass.max_concurrency):
+                waiter = pclass.queue.popleft()
+                if waiter.done():
+                    continue
+                pclass.active += 1
+                self.active_total += 1
+                waiter.set_result(None)
+
+    def _release(self, pclass):
+        pclass.active -= 1
+        self.active_total -= 1
+        self._dispatch()
+
+    def check_queue(self, class_name):
+        """Raise a 429 SchedulerRejected if the class' queue is full.
+
+        Called by slot(), and by callers that want to reject before doing
+        any work for a request that would not be queued anyway.
+        """
+        pclass = self._by_name[class_name]
+        if len(pclass.queue) >= pclass.max_queue_depth:
+            pclass.rejected_queue_full += 1
+            raise SchedulerRejected(
+                429,
+                f"Too many pending '{class_name}' requests, try again later",
+                retry_after=max(1, int(pclass.max_wait_s)),
+            )
+
+    @asynccontextmanager
+    async def slot(self, class_name, deadline=None):
+        """Wait for an LLM slot for the given class.
+
+        `deadline` is an absolute time.monotonic() value; the wait never
+        exceeds the class' max_wait_s either.
+        """
+        pclass = self._by_name[class_name]
+        enqueued_at = time.monotonic()
+        max_deadline = enqueued_at + pclass.max_wait_s
+        deadline = max_deadline if deadline is None else min(deadline, max_deadline)
+
+        self.check_queue(class_name)
+
+        waiter = asyncio.get_running_loop().create_future()
+        pclass.queue.append(waiter)
+        self._dispatch()
+
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), timeout=max(0.0, deadline - time.monotonic()))
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if waiter.done() and not waiter.cancelled():
+                # The slot was granted right as we gave up; give it back
+                self._release(pclass)
+            else:
+                waiter.cancel()
+                try:
+                    pclass.queue.remove(waiter)
+                except ValueError:
+                    pass
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            pclass.shed_deadline += 1
+            # Shed requests waited too; leaving them out would hide the worst waits
+            pclass.queue_wait.record(time.monotonic() - enqueued_at)
+            raise SchedulerRejected(
+                503,
+                f"'{class_name}' request could not be served before its deadline",
+                retry_after=max(1, int(pclass.max_wait_s)),
+            )
+
+        pclass.admitted += 1
+        pclass.queue_wait.record(time.monotonic() - enqueued_at)
+        try:
+            yield
+        finally:
+            self._release(pclass)
+
+    def stats(self):
+        """Per-class queue depth, admission counters and queue-wait latency"""
+        return {
+            "total_slots": self.total_slots,
+            "active_total": self.active_total,
+            "classes": {
+                pclass.name: {
+                    "queued": len(pclass.queue),
+                    "active": pclass.active,
+                    "max_concurrency": pclass.max_concurrency,
+                    "max_queue_depth": pclass.max_queue_depth,
+                    "admitted": pclass.admitted,
+                    "rejected_queue_full": pclass.rejected_queue_full,
+                    "shed_deadline": pclass.shed_deadline,
+                    "queue_wait": pclass.queue_wait.summary(),
+                }
+                for pclass in self.classes
+            },
+        }
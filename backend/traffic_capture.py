@@ -0,0 +1,138 @@
+import hashlib
+import json
+import re
+import threading
+import time
+
+# Endpoints whose traffic is captured
+CAPTURED_PATHS = ("/query", "/generate-report")
+
+# Capture modes: "hash" keeps only a digest and the size of every text,
+# "redact" keeps the text with emails, phone numbers and digits masked
+CAPTURE_MODES = ("hash", "redact")
+
+_EMAIL_RE = re.compile(r"[\w.+-]+@[\w-]+\.[\w.-]+")
+_PHONE_RE = re.compile(r"\+?\d[\d\s-]{6,}\d")
+_DIGIT_RE = re.compile(r"\d")
+
+
+def scrub_text(text, mode):
+    """Replace free text by a digest (hash mode) or a redacted copy (redact mode)"""
+    if mode == "redact":
+        text = _EMAIL_RE.sub("<email>", text)
+        text = _PHONE_RE.sub("<telefono>", text)
+        return _DIGIT_RE.sub("0", text)
+    return {
+        "sha": hashlib.sha256(text.encode("utf-8")).hexdigest()[:16],
+        "len": len(text),
+        "words": len(text.split()),
+    }
+
+
+def scrub_body(path, data, mode, classify=None):
+    """Keep the shape of a request body but never the raw user text"""
+    if not isinstance(data, dict):
+        return {"invalid": True}
+
+    if path == "/query":
+        body = {k: v for k, v in data.items() if k != "text"}
+        if "text" in data:
+            text = str(data["text"])
+            body["text"] = scrub_text(text, mode)
+            if classify is not None:
+                # Kept so a replay of hashed text lands in the same priority class
+                body["priority"] = classify(text)
+        return body
+
+    if path == "/generate-report":
+        conversation = data.get("conversation")
+        if not isinstance(conversation, dict):
+            return {"conversation": None}
+        if not isinstance(conversation.get("messages", []), list):
+            return {"conversation": {"messages": None}}
+        messages = [
+            {**{k: v for k, v in msg.items() if k != "content"},
+             "content": scrub_text(str(msg.get("content", "")), mode)}
+            for msg in conversation.get("messages", [])
+            if isinstance(msg, dict)
+        ]
+        return {"conversation": {"messages": messages}}
+
+    return {}
+
+
+class TrafficLog:
+    """Append-only JSON-lines log, one compact line per request"""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = open(path, "a", encoding="utf-8", buffering=1)
+
+    def append(self, record):
+        line = json.dumps(record, ensure_ascii=False, separators=(",", ":"))
+        with self._lock:
+            self._file.write(line + "\n")
+
+
+class TrafficCaptureMiddleware:
+    """ASGI middleware that records /query and /generate-report traffic.
+
+    Each record holds the arrival time, path, status, duration and the
+    scrubbed request body. Opt-in: main.py only installs it when
+    TRAFFIC_CAPTURE_PATH is set.
+    """
+
+    def __init__(self, app, log_path, mode="hash", classify=None):
+        if mode not in CAPTURE_MODES:
+            raise ValueError(f"Unknown capture mode '{mode}', expected one of {CAPTURE_MODES}")
+        self.app = app
+        self.log = TrafficLog(log_path)
+        self.mode = mode
+        self.classify = classify
+        print(f"Traffic capture enabled ({mode}) -> {log_path}")
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] not in CAPTURED_PATHS:
+            await self.app(scope, receive, send)
+            return
+
+        arrived_at = time.time()
+        started = time.monotonic()
+        chunks = []
+        status = {"code": 500}
+
+        async def capture_receive():
+            message = await receive()
+            if message["type"] == "http.request":
+                chunks.append(message.get("body", b""))
+            return message
+
+        async def capture_send(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, capture_receive, capture_send)
+        finally:
+            self._record(scope, arrived_at, time.monotonic() - started, status["code"], b"".join(chunks))
+
+    def _record(self, scope, arrived_at, duration, status_code, raw_body):
+        # Capture must never raise: this runs after the response was sent
+        try:
+            body = scrub_body(scope["path"], json.loads(raw_body or b"null"), self.mode, self.classify)
+        except Exception:
+            body = {"invalid": True}
+        try:
+            self.log.append({
+                "t": round(arrived_at, 3),
+                "method": scope["method"],
+                "path": scope["path"],
+                "status": status_code,
+                "ms": round(duration * 1000, 1),
+                "mode": self.mode,
+                "body": body,
+            })
+        except Exception as e:
+            print(f"Error writing traffic capture: {e}")